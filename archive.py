@@ -0,0 +1,512 @@
+"""
+    Author:
+        Taylor Cooper
+    Description:
+        Compressed, indexed archive of finished runs
+        Datalogs are stored as zlib compressed chunks of rows, an sqlite
+        index holds run metadata, per step statistics and per chunk
+        min/max so queries only decompress chunks that can match
+    Date Created:
+        October 19, 2026
+
+    Arguments and Inputs:
+        Datalog files, debuglog and recipe files next to them
+    Outputs:
+        archive.db with runs, steps and chunks tables
+        Query results as lists of dicts
+
+    History:
+    --------------------------------------------------------------
+    Date:
+    Author:    Taylor Cooper
+    Modification:
+     --------------------------------------------------------------
+"""
+
+import sqlite3, zlib, csv, os, glob, re
+
+# Archive location, defaults to the recipe archive folder
+path = "D:\\GitHub\\workspace\\A4_FreezeRay\\"
+ARCHIVE_DIR = path + 'RecipeArchive\\'
+ARCHIVE_DB = ARCHIVE_DIR + 'archive.db'
+CHUNK_ROWS = 256 # Datalog rows per compressed chunk, ~8.5 min at LOG_RATE
+
+# Metadata from the file name <date>_<gizmo>_<recipe>_<exp>_datalog_<ts>
+# and from the header lines run() copies from the recipe into the datalog.
+# Both are kept, header values in the header* columns.
+META = ('date', 'gizmo', 'recipe', 'experiment')
+META_KEYS = {
+    'Date': 'headerDate',
+    'GizmoNum': 'headerGizmo',
+    'RecipeNum': 'headerRecipe',
+    'ExperimentNum': 'headerExperiment',
+    }
+PLACEHOLDERS = ('', 'none', 'n/a', 'na', '-', 'tbd')
+PREFIXES = {'recipe': 'R', 'experiment': 'E'} # 0004 >> R04, like file names
+
+# Datalog columns, see controller.headers
+T, SP, SETPOINT, HS, EFFORT = 2, 3, 4, 5, 6
+
+# Debuglog rows written for failed attempts, see send() of each device.
+# Matched once runs of whitespace are collapsed, see LOG_RATE_ROW
+DEVICES = {'tcSerial': 'tcRetry', 'spSerial': 'spRetry', 
+           'arduinoSerial': 'ardRetry'}
+FAILURES = ('No reply!', 'checksum!', 'ETX!', 'ACK not found!')
+
+# Debuglog rows the controller writes about how it logged, the csv writer
+# doubles spaces so match any whitespace
+LOG_RATE_ROW = re.compile(r'Log\s+rate\s+\(s\):\s+([\d.]+)')
+ADAPTIVE_ROW = re.compile(r'Adaptive\s+log:')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY, name TEXT UNIQUE, date TEXT, gizmo TEXT,
+    recipe TEXT, experiment TEXT, headerDate TEXT, headerGizmo TEXT,
+    headerRecipe TEXT, headerExperiment TEXT, header TEXT, samples INTEGER,
+    logRate REAL, adaptive INTEGER,
+    tStart INTEGER, tEnd INTEGER, spMin REAL, spMax REAL, hsMax REAL,
+    rawSize INTEGER, size INTEGER, debuglog BLOB, recipeFile BLOB);
+CREATE TABLE IF NOT EXISTS steps (
+    run INTEGER, n INTEGER, step TEXT, description TEXT, samples INTEGER,
+    tStart INTEGER, tEnd INTEGER, spMin REAL, spMax REAL, spMean REAL,
+    spLast REAL, setPoint REAL, hsMax REAL, effortMax REAL);
+CREATE TABLE IF NOT EXISTS chunks (
+    run INTEGER, n INTEGER, tStart INTEGER, tEnd INTEGER,
+    spMin REAL, spMax REAL, data BLOB);
+CREATE INDEX IF NOT EXISTS runsMeta ON runs (gizmo, recipe, experiment);
+CREATE INDEX IF NOT EXISTS chunksRun ON chunks (run, tStart);
+'''
+
+
+def normalise(key, value):
+    """ Metadata value in file name format, None for placeholders.
+    e.g. ('recipe', '0004') >> 'R04', ('date', '2014.11.27') >> '20141127'
+    """
+
+    value = value.strip()
+    if value.lower() in PLACEHOLDERS: return None
+
+    if key == 'date':
+        return re.sub(r'[.\-/ ]', '', value)
+
+    if key in PREFIXES:
+        digits = re.match(r'[A-Za-z]?(\d+)', value)
+        if digits: return PREFIXES[key] + '%02d' % int(digits.group(1))
+
+    if key == 'gizmo':
+        return value.upper()
+
+    return value
+
+
+def parseRow(row):
+    """ Numeric values of a datalog sample row, None for other rows.
+    """
+
+    if len(row) < 14: return None
+
+    try:
+        values = [float(row[i]) for i in (T, SP, SETPOINT, HS, EFFORT)]
+    except ValueError:
+        return None
+
+    return values
+
+
+class runArchive():
+    """
+    Description:  Ingest finished runs and query them
+    Input: Datalog paths, query parameters
+    Output: archive.db, lists of runs, steps and samples
+    """
+
+    def __init__(self, dbPath=ARCHIVE_DB):
+        """ Open or create the archive index.
+        """
+
+        self.db = sqlite3.connect(dbPath)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+
+    def close(self):
+        """ Close the archive when done.
+        """
+
+        self.db.close()
+
+
+    def readMeta(self, lines, name):
+        """ Metadata from the file name and, separately, the datalog header
+        lines. Header values only fill in file name fields that are missing,
+        recipe templates often carry stale header values.
+        """
+
+        meta = {}
+        parts = name.split('_datalog')[0].split('_')
+        for key, value in zip(META, parts):
+            meta[key] = normalise(key, value)
+
+        for row in lines:
+            if not row or ':' not in row[0]: continue
+            key, value = row[0].split(':', 1)
+            key = key.strip()
+            if key in META_KEYS:
+                field = META_KEYS[key]
+                meta[field] = normalise(field[6:].lower(), value)
+
+        for key in META:
+            if meta.get(key) is None:
+                meta[key] = meta.get('header' + key.capitalize())
+
+        return meta
+
+
+    def ingest(self, datalogPath):
+        """ Compress and index a finished run, returns the run id.
+        Runs already in the archive or without samples are skipped.
+        """
+
+        name = os.path.basename(datalogPath).split('.csv')[0]
+
+        r = self.db.execute('SELECT id FROM runs WHERE name=?', (name,))
+        if r.fetchone():
+            print 'archive:: Already archived: ' + name
+            return None
+
+        f = open(datalogPath, 'rb')
+        raw = f.read()
+        f.close()
+
+        header = []
+        samples = [] # (values, row, line)
+        steps = []
+        for line, row in zip(raw.splitlines(), csv.reader(raw.splitlines())):
+
+            # Header rows are written at the start of every step
+            if row and 'Step' in row[0] and 'Number' in row[0]:
+                steps.append([])
+                continue
+
+            values = parseRow(row)
+            if values is None:
+                if not samples: header.append(row)
+                continue
+
+            # A new step number without a header row still splits steps
+            if not steps or (steps[-1] and steps[-1][-1][1][0] != row[0]):
+                steps.append([])
+            steps[-1].append((values, row, line))
+            samples.append((values, row, line))
+
+        if not samples:
+            print 'archive:: No samples found: ' + name
+            return None
+
+        meta = self.readMeta(header, name)
+
+        # Debuglog and recipe are kept whole, they are only read back raw
+        debuglog = self.readFile(datalogPath.replace('_datalog_',
+                                                     '_debuglog_'))
+        
+        # Fixed log rate and whether any step logged adaptively, runs from
+        # before the rate was logged have logRate None
+        logRate, adaptive = None, 0
+        if debuglog:
+            rate = LOG_RATE_ROW.search(debuglog)
+            if rate: logRate = float(rate.group(1))
+            adaptive = int(bool(ADAPTIVE_ROW.search(debuglog)))
+            debuglog = buffer(zlib.compress(debuglog))
+        
+        recipeFile = self.readCompressed(datalogPath.split('_datalog_')[0] +
+                                         '_recipe.csv')
+
+        sp = [s[0][1] for s in samples]
+        hs = [s[0][3] for s in samples]
+        cur = self.db.execute('''INSERT INTO runs (name, date, gizmo, recipe,
+            experiment, headerDate, headerGizmo, headerRecipe,
+            headerExperiment, header, samples, logRate, adaptive, tStart, 
+            tEnd, spMin, spMax, hsMax, rawSize, size, debuglog, recipeFile)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+            (name, meta['date'], meta['gizmo'], meta['recipe'],
+             meta['experiment'], meta.get('headerDate'),
+             meta.get('headerGizmo'), meta.get('headerRecipe'),
+             meta.get('headerExperiment'),
+             '\n'.join([','.join(row) for row in header]),
+             len(samples), logRate, adaptive, samples[0][0][0], samples[-1][0][0],
+             min(sp), max(sp), max(hs), len(raw), 0, debuglog, recipeFile))
+        run = cur.lastrowid
+
+        # Per step summary statistics
+        n = 0
+        for step in steps:
+            if not step: continue
+            sp = [s[0][1] for s in step]
+            self.db.execute('''INSERT INTO steps VALUES
+                (?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+                (run, n, step[0][1][0], step[0][1][1], len(step),
+                 step[0][0][0], step[-1][0][0], min(sp), max(sp),
+                 round(sum(sp)/len(sp), 2), sp[-1], step[-1][0][2],
+                 max([s[0][3] for s in step]),
+                 max([s[0][4] for s in step])))
+            n = n + 1
+
+        # Compressed chunks with a time and temperature zone map
+        size = 0
+        for n in range(0, len(samples), CHUNK_ROWS):
+            chunk = samples[n:n+CHUNK_ROWS]
+            sp = [s[0][1] for s in chunk]
+            data = zlib.compress('\n'.join([s[2] for s in chunk]))
+            size = size + len(data)
+            self.db.execute('INSERT INTO chunks VALUES (?,?,?,?,?,?,?)',
+                (run, n/CHUNK_ROWS, chunk[0][0][0], chunk[-1][0][0],
+                 min(sp), max(sp), buffer(data)))
+
+        self.db.execute('UPDATE runs SET size=? WHERE id=?', (size, run))
+        self.db.commit()
+
+        print 'archive:: Archived: ' + name + ' || ' + str(len(samples)) + \
+            ' samples, ' + str(len(raw)) + ' >> ' + str(size) + ' bytes'
+
+        return run
+
+
+    def ingestFolder(self, folder=ARCHIVE_DIR):
+        """ Ingest every datalog in a folder, returns new run ids.
+        """
+
+        runs = []
+        for p in sorted(glob.glob(os.path.join(folder, '*_datalog_*.csv'))):
+            run = self.ingest(p)
+            if run: runs.append(run)
+
+        return runs
+
+
+    def readFile(self, p):
+        """ Contents of file p, None if missing.
+        """
+
+        if not os.path.exists(p): return None
+
+        f = open(p, 'rb')
+        data = f.read()
+        f.close()
+
+        return data
+
+
+    def readCompressed(self, p):
+        """ Compressed contents of file p, None if missing.
+        """
+
+        data = self.readFile(p)
+        if data is None: return None
+
+        return buffer(zlib.compress(data))
+
+
+    def runs(self, **meta):
+        """ Runs matching metadata, e.g. runs(gizmo='M05', recipe='R04')
+        matches the file name, runs(headerRecipe='R04') the header lines.
+        Values are normalised the same way as on ingest, only the index is 
+        read, nothing is decompressed.
+        """
+
+        where, args = self.where(meta)
+        r = self.db.execute('''SELECT id, name, date, gizmo, recipe,
+            experiment, headerDate, headerGizmo, headerRecipe,
+            headerExperiment, samples, logRate, adaptive, tStart, tEnd, spMin, spMax, hsMax,
+            rawSize, size FROM runs''' + where + ' ORDER BY name', args)
+
+        return [dict(i) for i in r]
+
+
+    def where(self, meta, prefix=''):
+        """ SQL WHERE clause and arguments for metadata keywords.
+        """
+
+        for key in meta:
+            if key not in META and key not in META_KEYS.values():
+                raise KeyError('Unknown metadata: ' + key)
+
+        keys = sorted(meta)
+        if not keys: return '', ()
+
+        # Match values however they were written, 0004 finds R04
+        values = []
+        for k in keys:
+            field = k.startswith('header') and k[6:].lower() or k
+            values.append(normalise(field, str(meta[k])))
+
+        where = ' WHERE ' + ' AND '.join([prefix + k + '=?' for k in keys])
+        return where, tuple(values)
+
+
+    def steps(self, run):
+        """ Per step summary statistics for a run.
+        """
+
+        r = self.db.execute('SELECT * FROM steps WHERE run=? ORDER BY n',
+                            (run,))
+
+        return [dict(i) for i in r]
+
+
+    def readChunk(self, data):
+        """ Decompress a chunk into datalog rows.
+        """
+
+        return list(csv.reader(zlib.decompress(str(data)).splitlines()))
+
+
+    def samples(self, run, tStart=0, tEnd=None):
+        """ Datalog rows of a run between tStart and tEnd (s), only chunks
+        overlapping the range are decompressed.
+        """
+
+        if tEnd is None: tEnd = float('inf')
+
+        r = self.db.execute('''SELECT data FROM chunks
+            WHERE run=? AND tEnd>=? AND tStart<=? ORDER BY n''',
+            (run, tStart, tEnd))
+
+        rows = []
+        for (data,) in r:
+            for row in self.readChunk(data):
+                if tStart <= float(row[T]) <= tEnd:
+                    rows.append(row)
+
+        return rows
+
+
+    def reached(self, temp, within, below=True, **meta):
+        """ Runs whose spreader plate reached temp (C) within the first
+        `within` seconds, e.g. reached(-10, 600, gizmo='M05')
+        Returns (run, time reached) for each match. Chunks are only
+        decompressed when their min/max says they can match.
+        """
+
+        where, args = self.where(meta, prefix='runs.')
+        where = where and where + ' AND ' or ' WHERE '
+        if below:
+            where = where + 'chunks.spMin<=?'
+        else:
+            where = where + 'chunks.spMax>=?'
+
+        r = self.db.execute('''SELECT runs.id, runs.name, chunks.data
+            FROM chunks JOIN runs ON chunks.run=runs.id''' + where +
+            ' AND chunks.tStart<=? ORDER BY runs.id, chunks.n',
+            args + (temp, within))
+
+        found = []
+        for run, name, data in r:
+            if found and found[-1][0]['id'] == run: continue
+
+            for row in self.readChunk(data):
+                t, sp = float(row[T]), float(row[SP])
+                if t > within: break
+                if (below and sp <= temp) or (not below and sp >= temp):
+                    found.append(({'id': run, 'name': name}, t))
+                    break
+
+        return found
+
+
+    def latencyProfile(self, **meta):
+        """ Measured profile of archived runs for controller.dryRun:
+        attempts per command for each device from the debuglogs, time to
+        take one sample and bytes per datalog and debuglog row.
+        Keys are missing when there is nothing to measure them from.
+        
+        Sample time is the median over fixed rate runs of their fastest 
+        consistent interval less the run's log rate. Runs that logged
+        adaptively are left out. Runs from before the rate was logged only
+        give samplePeriod, the caller has to assume their rate.
+        """
+
+        counts = dict([(d, [0, 0]) for d in DEVICES]) # Rows, failed rows
+        sampleTimes, periods = [], []
+        samples, rawSize, dbRows, dbSize = 0, 0, 0, 0
+
+        for run in self.runs(**meta):
+            samples = samples + run['samples']
+            rawSize = rawSize + run['rawSize']
+
+            log = self.debuglog(run['id'])
+            if log:
+                lines = log.splitlines()
+                dbRows = dbRows + len(lines)
+                dbSize = dbSize + len(log)
+                for line in lines:
+                    line = ' '.join(line.split()) # Undo doubled spaces
+                    device = line.split('::')[0].strip()
+                    if device not in counts or 'Sent_Cmd' not in line:
+                        continue
+                    counts[device][0] = counts[device][0] + 1
+                    if [f for f in FAILURES if f in line]:
+                        counts[device][1] = counts[device][1] + 1
+
+            if run['adaptive']: continue
+
+            # Time between samples within the same step
+            dts = []
+            prev = None
+            for row in self.samples(run['id']):
+                if prev and prev[0] == row[0]:
+                    dts.append(float(row[T]) - float(prev[T]))
+                prev = row
+            if not dts: continue
+
+            # Times are whole seconds, a 2.6s period logs as 2s and 3s gaps,
+            # longer gaps are pauses or retries
+            fastest = [dt for dt in dts if dt <= min(dts) + 1]
+            period = sum(fastest)/len(fastest)
+            if run['logRate'] is None:
+                periods.append(period)
+            else:
+                sampleTimes.append(max(period - run['logRate'], 0))
+
+        profile = {}
+        for device, (rows, failed) in counts.items():
+            if rows > failed:
+                profile[DEVICES[device]] = float(rows)/(rows - failed)
+        if sampleTimes:
+            profile['sampleTime'] = sorted(sampleTimes)[len(sampleTimes)/2]
+        elif periods:
+            profile['samplePeriod'] = sorted(periods)[len(periods)/2]
+        if samples:
+            profile['rowBytes'] = float(rawSize)/samples
+        if dbRows:
+            profile['debugBytes'] = float(dbSize)/dbRows
+
+        return profile
+
+
+    def debuglog(self, run):
+        """ Decompressed debuglog of a run, None if it was not found.
+        """
+
+        r = self.db.execute('SELECT debuglog FROM runs WHERE id=?', (run,))
+        data = r.fetchone()[0]
+
+        if data is None: return None
+        return zlib.decompress(str(data))
+
+
+if __name__ == '__main__':
+
+    arc = runArchive()
+    arc.ingestFolder()
+
+    for run in arc.runs():
+        print run['name'], run['gizmo'], run['recipe'], run['experiment'], \
+            run['samples'], 'samples'
+
+#     # Query examples
+#     print arc.runs(gizmo='M05')
+#     print arc.reached(-10, 600, gizmo='M05') # -10C within 10 min
+#     print arc.samples(1, tStart=600, tEnd=1200)
+#     print arc.steps(1)
+
+    arc.close()
@@ -23,15 +23,36 @@
      --------------------------------------------------------------
 """
 
-import serial, time, collections, csv, msvcrt
+import serial, time, collections, csv, msvcrt, threading, math
+import archive
 
 # Logging files and recipe
 recipeName = "20141127_M05_R04_E01_recipe.csv"
 path = "D:\\GitHub\\workspace\\A4_FreezeRay\\"
-dbLP = path + recipeName.split('_recipe')[0] + '_debuglog'
-dtLP = path + recipeName.split('_recipe')[0] + '_datalog'
-recipe = path + recipeName
+
+def logPaths(recipeName):
+    """ Debug log, datalog and recipe paths for a recipe file name.
+    """
+    
+    base = path + recipeName.split('_recipe')[0]
+    return base + '_debuglog', base + '_datalog', path + recipeName
+
+dbLP, dtLP, recipe = logPaths(recipeName)
 LOG_RATE = 2 # Log data every X seconds by default, max rate ~=2
+
+# Adaptive logging, sample every LOG_RATE_MIN s during transients and back
+# off towards LOG_RATE_MAX s during holds. Recipe columns "Min Log Rate (s)"
+# and "Max Log Rate (s)" before Comments, when filled in, override per step
+# and turn it on for that step.
+# The watchdog reads TC alarm and temperatures itself, so long intervals
+# during holds do not slow down its checks.
+ADAPTIVE_LOG = False
+LOG_RATE_MIN = LOG_RATE
+LOG_RATE_MAX = 20
+LOG_RATE_CAP = 20 # Any max is clamped here
+LOG_DTDT = 0.02 # Transient if spreader plate changes faster (C/s)
+LOG_BAND = 0.5 # Transient if plate is further from set point (C)
+LOG_EFFORT = 5 # Transient if TC effort changes by more (%)
     
 # DEBUG MODE FROM ARDUINO
 
@@ -39,18 +60,219 @@ DEBUG = False
 
 # Serial communication parameters, based on test run of 1000 logs
 SP_DELAY=0.10 
-TC_DELAY=0.10
+TC_DELAY=0.10 # Max wait, TC replies are read as soon as the ACK arrives
+TC_POLL=0.002
 ARD_DELAY_CMD=3 ### Something should be done about this...
 ARD_DELAY_QRY=0.2
 SP_RETRIES=15
 TC_RETRIES=15
 ARD_RETRIES=30
 
+# Start up, ports are polled for readiness instead of fixed sleeps
+READY_TIMEOUT=3 # Max wait for a device to answer, Arduino reset ~=1.5s
+READY_POLL=0.01 # Polling interval while waiting
+READY_QUIET=0.05 # Line is idle after this long without new bytes
+
+# Keep ports open between recipes and prompt for the next one
+DAEMON = False
+
+# Ingest finished runs into the compressed archive, see archive.py
+ARCHIVE = True
+
+# Estimate run time and serial load of the recipe instead of running it,
+# latencies are measured from archived runs when there are any
+DRY_RUN = False
+DRY_ROW_BYTES = 95 # Datalog bytes per sample if nothing is archived
+DRY_HEADER_BYTES = 220 # Datalog header row written for every step
+DRY_DEBUG_BYTES = 70 # Debuglog bytes per row if nothing is archived
+DRY_TRANSIENT = 300 # Adaptive steps with TC on assumed to ramp this long (s)
+
+# Watchdog, polls TC alarm and temperatures in its own thread, checks rules
+# and shuts down TC, fan and pump
+WD_PERIOD=0.1 # Poll and check interval (s), with ~30ms per TC query a
+              # fault is acted on within ~150ms whatever the main loop does
+WD_POLL = (('alarm', '05'), ('spTemp', '01'), ('hsTemp', '06'))
+WD_STALE=1 # Max age of readings (s), ~10 polls missed in a row
+WD_TIMEOUT=30 # Max time without a valid reply from any device (s)
+WD_REPEATS=3 # Shutdown commands are sent blind, repeat to be sure
+
+# Only queries and off commands are sent to a device after the watchdog
+# kills it, anything else is refused so nothing is turned back on
+SP_SAFE = ('DIS', 'STP')
+TC_SAFE = ('01', '03', '04', '05', '06') # TC off ('2d' 0) also allowed
+ARD_SAFE = ('Q',) # Fan and pump off (data 0) also allowed
+
+# Watchdog rules: (Description, reading, low limit, high limit)
+# Trips when reading < low or reading > high, None disables a limit
+WD_RULES = [
+    ('TC alarm bit set', 'alarm', None, 0),
+    ('Spreader plate over temperature', 'spTemp', None, 70),
+    ('Spreader plate under temperature', 'spTemp', -25, None),
+    ('Heatsink over temperature', 'hsTemp', None, 60),
+    ('Heatsink under temperature', 'hsTemp', 0, None),
+    ]
+
 # SygPump, TC, Arduino (4 = COM5 in Windows)
 # e.g. (None,None,'COM6') tries to open communication with Arduino on COM6 
 # ports = (None,None,'COM6')
 ports = ('COM8','COM7','COM6')
 
+def getSeconds(s):
+    """ Convert stings of this format to seconds.
+    10h-10m-10s
+    3s
+    7m-9s
+    1h-5s
+    """
+    duration = 0
+    
+    for i in s.split('-'):
+        if 'h' in i: duration = duration + int(i.split('h')[0])*3600
+        if 'm' in i: duration = duration + int(i.split('m')[0])*60
+        if 's' in i: duration = duration + int(i.split('s')[0])
+            
+    return duration
+
+
+def getRate(s):
+    """ Convert a log rate to seconds, plain numbers or getSeconds() 
+    format. Raises ValueError unless it is > 0.
+    2.5
+    5s
+    1m-30s
+    """
+    
+    try:
+        rate = float(s)
+    except ValueError:
+        try:
+            rate = getSeconds(s)
+        except ValueError:
+            rate = 0
+    
+    if not rate > 0:
+        raise ValueError(repr(s) + ' is not a log rate > 0, e.g. 2.5 or 5s')
+    
+    return rate
+
+
+def logRates(step):
+    """ Adaptive log rate bounds for a step, None if not adaptive.
+    Steps that fill in the min/max columns before the comment override 
+    defaults, empty columns change nothing. Raises ValueError for a rate
+    getRate() does not accept.
+    """
+    
+    rates = [LOG_RATE_MIN, LOG_RATE_MAX]
+    overrides = False
+    
+    if len(step) > 12:
+        for i, column in enumerate(('Min Log Rate (s)', 'Max Log Rate (s)')):
+            if not step[10 + i].strip(): continue
+            try:
+                rates[i] = getRate(step[10 + i].strip())
+            except ValueError as e:
+                raise ValueError('Step ' + step[0] + ' ' + column + ': ' + 
+                                 str(e))
+            overrides = True
+    
+    if not (ADAPTIVE_LOG or overrides):
+        return None
+    
+    minRate = min(rates[0], LOG_RATE_CAP)
+    maxRate = min(rates[1], LOG_RATE_CAP)
+    
+    return minRate, max(minRate, maxRate)
+
+
+def recipeSteps(recipePath):
+    """ Recipe rows after the header row, as controller.run() reads them.
+    """
+    
+    recipeFile = open(recipePath, 'rb')
+    rows = []
+    firstLineFound = False
+    
+    for row in csv.reader(recipeFile):
+        if row and 'Step Number' in row[0]:
+            firstLineFound = True
+        elif firstLineFound and row:
+            rows.append(row)
+    
+    recipeFile.close()
+    return rows
+
+
+def checkRecipe(recipePath):
+    """ Raises ValueError for the first step that would fail part way 
+    through a run, checked before any step is executed.
+    """
+    
+    for step in recipeSteps(recipePath):
+        logRates(step)
+
+
+def waitForData(ser, timeout=READY_TIMEOUT):
+    """ Poll until bytes are waiting on ser, returns False on timeout.
+    """
+    
+    tEnd = time.time() + timeout
+    while ser.inWaiting() == 0:
+        if time.time() > tEnd: return False
+        time.sleep(READY_POLL)
+    return True
+
+
+class deviceError(Exception):
+    """ A device did not answer, raised so the run can be shut down safely.
+    """
+    pass
+
+
+def sendFailed(device, cmd, retries):
+    """ Log a command that ran out of retries, returns the error to raise.
+    """
+    
+    errMsg = device.__class__.__name__ + ':: ' + device.port + \
+        ' no valid reply to ' + cmd + ' after ' + str(retries) + ' tries'
+    print errMsg
+    device.dbF.writerow([errMsg])
+    
+    return deviceError(errMsg)
+
+
+def sendRefused(device, cmd):
+    """ Log a command refused after the watchdog killed device.
+    """
+    
+    refMsg = device.__class__.__name__ + ':: Refused_Cmd: ' + cmd + \
+        ' || Watchdog tripped'
+    if DEBUG: print refMsg
+    device.dbF.writerow([refMsg])
+
+
+class lockedWriter():
+    """
+    Description:  Thread safe wrapper around a csv writer
+    Input: csv writer
+    Output: Rows written one at a time, writer can be swapped between runs
+    """
+    
+    def __init__(self, writer):
+        self.writer = writer
+        self.lock = threading.Lock()
+        
+    def setWriter(self, writer):
+        """ Point all users of this log at a new csv writer.
+        """
+        with self.lock:
+            self.writer = writer
+        
+    def writerow(self, row):
+        with self.lock:
+            self.writer.writerow(row)
+
+
 class spSerial():
     """
     Description:  Sends commands to pump over serial.
@@ -70,15 +292,21 @@ class spSerial():
         # To change pump baud rate run "*ADR 0 B 9600" in Arduino serial 
         # monitor. This change will last through reset.
         self.ser = serial.Serial(self.port, baudrate=9600, timeout=1)
-        time.sleep(1) # Give serial port time to set up
+        self.writeLock = threading.Lock() # Shared with the watchdog
+        self.killed = False # Set by the watchdog, see kill()
+        self.lastReply = time.time()
         
         beginMsg = 'NE-500 Syringe pump communication established!'
         print beginMsg
         self.dbF.writerow([beginMsg])
         
-        # Initialize diameter
-        self.send('*RESET',delay=1) # Reset pump, wait longer
-        self.send('DIA'+str(diameter)) # Assign syringe diameter
+        # Initialize diameter, reset returns as soon as the pump answers
+        try:
+            self.send('*RESET', delay=READY_TIMEOUT, poll=True) # Reset pump
+            self.send('DIA'+str(diameter)) # Assign syringe diameter
+        except:
+            self.ser.close()
+            raise
 
 
     def closeSer(self):
@@ -112,9 +340,26 @@ class spSerial():
 
         return s
     
+    
+    def readUntil(self, timeout):
+        """ Read until a reply ending in ETX arrives or timeout elapses.
+        """
+        
+        s = ""
+        tEnd = time.time() + timeout
+        
+        while time.time() < tEnd:
+            s = s + self.read()
+            if s and s[-1] == '\x03': break
+            time.sleep(READY_POLL)
+        
+        return s
+    
 
-    def send(self, s, delay = SP_DELAY, retries=SP_RETRIES):
+    def send(self, s, delay = SP_DELAY, retries=SP_RETRIES, poll=False):
         """ String is written directly to serial port.
+        If poll is set delay is the longest wait for a reply, not a fixed
+        sleep.
         """
         
         # Send and receive cmd
@@ -122,10 +367,16 @@ class spSerial():
         spMsg = 'spSerial:: Sent_Cmd: ' + s + ' ||  '
         
         for i in range(retries):
-            self.ser.write(cmd)
-            time.sleep(delay) # Delay in seconds before response
+            with self.writeLock:
+                if self.killed and s not in SP_SAFE:
+                    return sendRefused(self, s)
+                self.ser.write(cmd)
             
-            r = self.read()
+            if poll:
+                r = self.readUntil(delay)
+            else:
+                time.sleep(delay) # Delay in seconds before response
+                r = self.read()
             
             if not r: # Basically just check if you get a reply
                 self.dbF.writerow([spMsg+'No reply!'])
@@ -137,9 +388,12 @@ class spSerial():
                 if DEBUG: print spMsg+'Did not receive ETX!'
                 continue
             else:
+                self.lastReply = time.time()
                 break
+        else:
+            raise sendFailed(self, s, retries)
         
-        # Let the user know what happened, no error handling
+        # Let the user know what happened
         row = spMsg + ' ||  Received:' + r
         self.dbF.writerow([row])
         if DEBUG: print row
@@ -147,6 +401,17 @@ class spSerial():
         return r
     
     
+    def kill(self):
+        """ Stop the pump without waiting for a reply, used by watchdog.
+        Only SP_SAFE commands are sent afterwards.
+        """
+        
+        with self.writeLock:
+            self.killed = True
+            for i in range(WD_REPEATS):
+                self.ser.write('STP\x0D')
+    
+    
     def basicCommand(self, vol, rate=1000):
         """ A basic command for the syringe pump, will infuse positive volumes
         and withdraw negative volumes.
@@ -202,7 +467,19 @@ class tcSerial():
 
         # Open port
         self.ser = serial.Serial(self.port, baudrate=9600, timeout=1)
-        time.sleep(1) # Give serial port time to set up
+        self.writeLock = threading.Lock() # Shared with the watchdog
+        self.ioLock = threading.Lock() # Held for a whole write and read
+        self.waiting = False # Watchdog wants the port next, see query()
+        self.replies = {} # Last reply to send() and its time per query
+        self.killed = False # Set by the watchdog, see kill()
+        self.lastReply = time.time()
+        
+        # Handshake, reading the plate temperature retries until TC answers
+        try:
+            self.send('01')
+        except:
+            self.ser.close()
+            raise
         
         beginMsg = 'TC-36-25_RS232 Temperature controller'
         beginMsg = beginMsg + ' communication established!'
@@ -272,27 +549,31 @@ class tcSerial():
 
 
     def read(self, delay):
-        """ Read chars from the serial port buffer well it is not empty.
+        """ Read chars from the serial port buffer until the ACK, waits
+        at most delay seconds for it.
         """
     
         buf = []
         seeking_sync = True;
         seeking_end = True;
+        tEnd = time.time() + delay
     
-        time.sleep(delay)
         # Read serial into buffer and then pop out to s for return
-        while self.ser.inWaiting() > 0:
-            ch = self.ser.read(1) #Read 1 BYTE
-
-            if seeking_sync:
-                if ch == self.stx: # <STX>
-                    seeking_sync = False
-            elif seeking_end:
-                if ch == self.ack: # <ACK>
+        while seeking_end:
+            while seeking_end and self.ser.inWaiting() > 0:
+                ch = self.ser.read(1) #Read 1 BYTE
+    
+                if seeking_sync:
+                    if ch == self.stx: # <STX>
+                        seeking_sync = False
+                elif ch == self.ack: # <ACK>
                     buf.append(self.ack)
                     seeking_end = False
                 else:
                     buf.append(ch)
+            
+            if time.time() > tEnd: break
+            if seeking_end: time.sleep(TC_POLL)
         
                
         if not buf: # No reply received
@@ -309,14 +590,23 @@ class tcSerial():
         1ms delay is the expected delay before a reply
         """
         
+        safe = cmd in TC_SAFE or (cmd == '2d' and data == self.formatData(0))
+        query = data == '00000000' and cmd
         cmd = self.adr + cmd + data
         s = self.stx + cmd + self.getChecksum(cmd) + self.etx
         tcMsg = 'tcSerial:: Sent_Cmd: ' + cmd + ' ||  Received:'
                 
         for i in range(retries):
-            self.ser.write(s)
-            
-            reply = self.read(delay)
+            # The watchdog polls between attempts, never in the middle
+            while self.waiting: time.sleep(TC_POLL)
+            with self.ioLock:
+                with self.writeLock:
+                    if self.killed and not safe:
+                        return sendRefused(self, cmd)
+                    self.ser.flushInput() # Late replies of other cmds
+                    self.ser.write(s)
+                
+                reply = self.read(delay)
                         
             # If no reply re-send command
             if not reply:
@@ -336,14 +626,64 @@ class tcSerial():
                 if DEBUG: print tcMsg+'Received invalid checksum!'
                 continue
             else:
+                self.lastReply = time.time()
+                if query: self.replies[query] = (reply, self.lastReply)
                 break
+        else:
+            raise sendFailed(self, cmd, retries)
 
-        # Let the user know what happened, no error handling
+        # Let the user know what happened
         row = tcMsg + reply
         if DEBUG: print row
         self.dbF.writerow([row])
         
         return reply
+    
+    
+    def query(self, cmd, delay=TC_DELAY):
+        """ Single read for the watchdog polls, not logged and not retried.
+        Returns the reply, False if there was no valid one.
+        """
+        
+        cmd = self.adr + cmd + '00000000'
+        s = self.stx + cmd + self.getChecksum(cmd) + self.etx
+        
+        self.waiting = True
+        with self.ioLock:
+            self.waiting = False
+            with self.writeLock:
+                self.ser.flushInput()
+                self.ser.write(s)
+            reply = self.read(delay)
+        
+        if not reply or 'X' in reply:
+            return False
+        if self.getChecksum(reply[:-2]) != reply[-2:]:
+            return False
+        
+        self.lastReply = time.time()
+        return reply
+    
+    
+    def kill(self):
+        """ Turn off TC without waiting for a reply, used by watchdog.
+        Only TC_SAFE commands and TC off are sent afterwards.
+        """
+        
+        cmd = self.adr + '2d' + self.formatData(0)
+        s = self.stx + cmd + self.getChecksum(cmd) + self.etx
+        
+        with self.writeLock:
+            self.killed = True
+            for i in range(WD_REPEATS):
+                self.ser.write(s)
+        
+        # Keep the replies from being read as those of the next command
+        self.waiting = True
+        with self.ioLock:
+            self.waiting = False
+            time.sleep(TC_DELAY)
+            self.ser.flushInput()
       
         
 class arduinoSerial():
@@ -363,16 +703,29 @@ class arduinoSerial():
         buf = []
 
         # Open port, nominal baudrate = 19200, TC required 9600 though
+        # Opening the port resets the Arduino, it prints a banner when ready
         self.ser = serial.Serial(self.port, baudrate=9600, timeout=1)
-        time.sleep(1) # Give serial port time to set up
+        self.writeLock = threading.Lock() # Shared with the watchdog
+        self.killed = False # Set by the watchdog, see kill()
+        waitForData(self.ser)
+        self.lastReply = time.time()
         
-        # Clearing serial buffer
-        while self.ser.inWaiting() > 0:
-            ch = self.ser.read(1) #Read 1 BYTE
-            buf.append(ch)
+        # Clearing serial buffer, keep reading until the banner stops
+        while waitForData(self.ser, READY_QUIET):
+            while self.ser.inWaiting() > 0:
+                ch = self.ser.read(1) #Read 1 BYTE
+                buf.append(ch)
         debugRow = ''.join(buf) 
         print debugRow
-        self.dbF.writerow([debugRow])        
+        self.dbF.writerow([debugRow])
+        
+        # Handshake, the banner alone does not prove the Arduino answers
+        try:
+            self.send('Q', delay=ARD_DELAY_QRY, 
+                      retries=int(READY_TIMEOUT/ARD_DELAY_QRY))
+        except:
+            self.ser.close()
+            raise
         
     def closeSer(self):
         """ Close serial port when done.
@@ -438,10 +791,14 @@ class arduinoSerial():
         # Format output string, requires data members to be strings
         # chr(0) = <NULL>
         s = chr(2)+cmd+','.join(data)+chr(0)+chr(3)
+        safe = cmd in ARD_SAFE or data == [str(0)]
 
         for i in range(retries):
             # Send command         
-            self.ser.write(s)
+            with self.writeLock:
+                if self.killed and not safe:
+                    return sendRefused(self, cmd)
+                self.ser.write(s)
             #time.sleep(0.2) ### THIS IS CRAZY, without this delay it breaks...
             
             self.ardMsg = 'arduinoSerial:: Sent_Cmd: ' + cmd
@@ -452,19 +809,379 @@ class arduinoSerial():
             if not reply: # Try again if no reply received
                 continue  
             else:
+                self.lastReply = time.time()
                 break
+        else:
+            raise sendFailed(self, cmd, retries)
                  
         ### Note no sequence byte or checksum implemented
         # Format reply and return
         rCmd, rData = reply
-        # Let the user know what happened, no error handling
+        # Let the user know what happened
         self.ardMsg = self.ardMsg + rCmd+'_'+':'.join(rData)
         self.dbF.writerow([self.ardMsg])
         if DEBUG: print self.ardMsg
         
         return reply
     
+    
+    def kill(self):
+        """ Turn off fan and pump without waiting for a reply, used by 
+        watchdog. Only ARD_SAFE commands and off are sent afterwards.
+        """
+        
+        with self.writeLock:
+            self.killed = True
+            for i in range(WD_REPEATS):
+                self.ser.write(chr(2)+'F'+str(0)+chr(0)+chr(3))
+                self.ser.write(chr(2)+'P'+str(0)+chr(0)+chr(3))
+    
 
+class watchdog():
+    """
+    Description:  Safety interlock polled and checked in its own thread, 
+    independent of serial delays and retries in the sampling loop
+    Input: TC readings polled every WD_PERIOD, readings from 
+    controller.log(), device reply times
+    Output: TC, pump and fan shut down when a rule trips
+    """
+    
+    def __init__(self, devices, debugLogFile, tc=None, rules=WD_RULES):
+        
+        self.devices = devices # TC first, it is the one that matters most
+        self.dbF = debugLogFile
+        self.tc = tc # Polled for WD_POLL readings when there is one
+        self.rules = rules
+        self.lock = threading.Lock()
+        self.readings = {}
+        self.tReadings = {} # Time of each reading
+        self.since = time.time()
+        self.armed = False # Staleness and timeouts only checked when armed
+        self.tripped = False
+        self.running = False
+        
+    def start(self):
+        """ Start polling and checking rules every WD_PERIOD seconds.
+        """
+        
+        self.running = True
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def stop(self):
+        """ Stop the watchdog thread.
+        """
+        
+        self.running = False
+        self.thread.join()
+        
+    def arm(self):
+        """ Start a run, forget old readings and restart the clocks.
+        """
+        
+        with self.lock:
+            self.readings = {}
+            self.tReadings = {}
+            self.since = time.time()
+            self.tripped = False
+            self.armed = True
+        
+        # Devices accept commands again for the new run
+        for d in self.devices:
+            with d.writeLock:
+                d.killed = False
+            
+    def disarm(self):
+        """ Waiting on the user or idle, devices are expected to go quiet.
+        """
+        
+        self.armed = False
+        
+    def rearm(self):
+        """ Resume checking staleness and timeouts after disarm.
+        """
+        
+        with self.lock:
+            self.since = time.time()
+            self.armed = True
+        
+    def update(self, **readings):
+        """ Called by poll() and the sampling loop with the latest readings.
+        """
+        
+        now = time.time()
+        with self.lock:
+            self.readings.update(readings)
+            for key in readings:
+                self.tReadings[key] = now
+    
+    def poll(self, key, cmd):
+        """ Read one WD_POLL register from the TC, the sampling loop's
+        reply is used instead if it is less than WD_PERIOD old.
+        """
+        
+        reply, tReply = self.tc.replies.get(cmd, (False, 0))
+        
+        if time.time() - tReply > WD_PERIOD:
+            try:
+                reply = self.tc.query(cmd)
+            except Exception:
+                reply = False # Port gone, readings go stale and trip
+            if not reply: return
+        
+        if key == 'alarm':
+            self.update(alarm=int(reply[:-2],16))
+        else:
+            self.update(**{key: self.tc.formatResponse(reply)})
+            
+    def check(self):
+        """ Returns a description of the first rule broken, else None.
+        """
+        
+        now = time.time()
+        with self.lock:
+            readings = dict(self.readings)
+            since = self.since
+            times = [self.tReadings.get(key, 0) for key, cmd in WD_POLL]
+        
+        # Polled readings must all be fresh, else the last sample will do
+        tReading = max(min(times) if self.tc else max(times), since)
+        
+        for desc, key, low, high in self.rules:
+            if key not in readings: continue
+            value = readings[key]
+            if low is not None and value < low:
+                return desc + ': ' + str(value)
+            if high is not None and value > high:
+                return desc + ': ' + str(value)
+        
+        if not self.armed:
+            return None
+        
+        if now - tReading > WD_STALE:
+            return 'Readings stale for ' + str(round(now - tReading, 1)) + 's'
+        
+        for d in self.devices:
+            age = now - max(d.lastReply, since)
+            if age > WD_TIMEOUT:
+                return d.__class__.__name__ + ' no reply for ' + \
+                    str(int(age)) + 's'
+        
+        return None
+    
+    def trip(self, reason):
+        """ Shut everything down, the sampling loop stops on self.tripped.
+        """
+        
+        self.tripped = True
+        failed = ''
+        
+        # A broken port must not stop the other devices being shut down
+        for d in self.devices:
+            try:
+                d.kill()
+            except Exception as e:
+                failed = failed + ' || ' + d.__class__.__name__ + \
+                    ' kill failed: ' + str(e)
+        
+        wdMsg = 'watchdog:: Tripped, devices shut down! ' + reason + failed
+        print wdMsg
+        self.dbF.writerow([wdMsg])
+            
+    def loop(self):
+        """ Poll and check rules until stopped, trips once per run.
+        """
+        
+        while self.running:
+            tNext = time.time() + WD_PERIOD
+            
+            # Rules checked after every reading, not once per period
+            for key, cmd in WD_POLL:
+                if self.tc: self.poll(key, cmd)
+                if not self.tripped:
+                    reason = self.check()
+                    if reason: self.trip(reason)
+            
+            time.sleep(max(0, tNext - time.time()))
+        
+        
+class dryRun():
+    """
+    Description:  Estimate a recipe without opening any ports
+    Input: Recipe path, latency profile (see archive.latencyProfile)
+    Output: Per step and total run time, samples, serial commands per 
+    device and log sizes, steps too short for one sample are flagged
+    """
+    
+    def __init__(self, recipePath, profile={}):
+        
+        self.recipePath = recipePath
+        
+        # Attempts per command, 1 = every command answered first time
+        self.tcRetry = profile.get('tcRetry', 1.0)
+        self.spRetry = profile.get('spRetry', 1.0)
+        self.ardRetry = profile.get('ardRetry', 1.0)
+        self.rowBytes = profile.get('rowBytes', DRY_ROW_BYTES)
+        self.debugBytes = profile.get('debugBytes', DRY_DEBUG_BYTES)
+        
+        # Every attempt waits the full delay before reading the reply,
+        # an upper bound for the TC which is read as soon as it replies
+        self.tcCmd = TC_DELAY*self.tcRetry
+        self.spCmd = SP_DELAY*self.spRetry
+        self.ardCmd = ARD_DELAY_CMD*self.ardRetry
+        
+        # Time to take one sample, log() sleeps LOG_RATE on top of this.
+        # Archived runs that did not record their rate are assumed LOG_RATE
+        if 'sampleTime' in profile:
+            self.sampleTime = profile['sampleTime']
+        elif 'samplePeriod' in profile:
+            self.sampleTime = max(profile['samplePeriod'] - LOG_RATE, 0)
+        else:
+            self.sampleTime = 5*self.tcCmd + ARD_DELAY_QRY*self.ardRetry + \
+                self.spCmd
+        
+    def steps(self):
+        """ Recipe rows after the header row, as run() reads them.
+        """
+        
+        return recipeSteps(self.recipePath)
+    
+    def transient(self, step, delay):
+        """ How long an adaptive step is expected to sample at its minimum
+        rate, see controller.nextRate().
+        """
+        
+        # Air pump running counts as a transient the whole step
+        if int(step[6]) > 0:
+            return delay
+        
+        # Syringe pump moving, volume (uL) at rate (uL/min)
+        window = 0
+        if int(step[7]) != 0 and int(step[8]) > 0:
+            window = 60.0*abs(int(step[7]))/int(step[8])
+        
+        # Ramp to a new set point
+        if step[3] == 'Y':
+            window = max(window, DRY_TRANSIENT)
+        
+        return min(window, delay)
+    
+    def adaptiveSamples(self, delay, transient, minRate, maxRate):
+        """ Samples of an adaptive step, mirrors controller.logAdaptive():
+        minRate during the transient window, then the interval doubles up 
+        to maxRate.
+        """
+        
+        t, samples = 0, 0
+        rate = minRate
+        
+        while t < delay:
+            samples = samples + 1
+            if t < transient:
+                rate = minRate
+            else:
+                rate = min(2*rate, maxRate)
+            t = t + max(rate, self.sampleTime)
+        
+        return samples
+    
+    def estimateStep(self, step):
+        """ Estimate for one step, mirrors executeStep() and log().
+        """
+        
+        delay = getSeconds(step[2])
+        vol = int(step[7]) != 0
+        rates = logRates(step)
+        e = {'step': step[0], 'description': step[1], 'duration': delay,
+             'flags': []}
+        
+        # Pump and fan efforts, TC set point and enable, syringe pump
+        setup = 2*self.ardCmd + 2*self.tcCmd + vol*4*self.spCmd
+        
+        if rates:
+            # Time bounded, transient window then backing off in the hold
+            period = max(rates[0], self.sampleTime)
+            transient = self.transient(step, delay)
+            e['samples'] = self.adaptiveSamples(delay, transient, *rates)
+            logTime = delay
+            e['flags'].append('Adaptive, assumes ' + str(int(transient)) + 
+                's transient then hold, upper bound ' + 
+                str(int(math.ceil(delay/period))) + ' samples')
+        else:
+            # Fixed count, every sample overruns the rate by sampleTime
+            period = LOG_RATE + self.sampleTime
+            e['samples'] = delay/LOG_RATE
+            logTime = e['samples']*period
+        
+        if delay < period:
+            e['flags'].append('Shorter than one sample period (' + 
+                              str(round(period, 2)) + 's)')
+        if step[9] == 'Y':
+            e['flags'].append('Waits for user, not included')
+        
+        e['time'] = setup + logTime
+        
+        # Commands sent, each sample is 5 TC queries, 1 Arduino, 1 pump
+        e['tc'] = 2 + 5*e['samples']
+        e['sp'] = vol*4 + e['samples']
+        e['ard'] = 2 + e['samples']
+        
+        # Watchdog polls the TC every WD_PERIOD unless a sample just did,
+        # these are not written to the debuglog
+        polls = int(e['time']/WD_PERIOD) - e['samples']
+        e['wd'] = len(WD_POLL)*max(0, polls)
+        
+        # One datalog header per step, one debuglog row per attempt
+        e['datalog'] = DRY_HEADER_BYTES + e['samples']*self.rowBytes
+        attempts = e['tc']*self.tcRetry + e['sp']*self.spRetry + \
+            e['ard']*self.ardRetry
+        e['debuglog'] = (attempts + e['samples'])*self.debugBytes
+        
+        return e
+    
+    def estimate(self):
+        """ Estimates for every step and the totals, including closing the
+        ports at the end of the run.
+        """
+        
+        steps = [self.estimateStep(s) for s in self.steps()]
+        total = {'time': 2*self.ardCmd + self.tcCmd + self.spCmd,
+                 'tc': 1, 'sp': 1, 'ard': 2} # closeSer() of each device
+        
+        for key in ('duration', 'samples', 'wd', 'datalog', 'debuglog'):
+            total[key] = 0
+        for e in steps:
+            for key in total:
+                total[key] = total[key] + e[key]
+        
+        return steps, total
+    
+    def report(self):
+        """ Print the estimate, returns it as well.
+        """
+        
+        steps, total = self.estimate()
+        
+        print 'Dry run: ' + self.recipePath
+        print '%-6s%-24s%10s%10s%9s%6s%6s%6s%8s' % ('Step', 'Description',
+            'Recipe(s)', 'Est.(s)', 'Samples', 'TC', 'SP', 'Ard', 'WD')
+        
+        for e in steps:
+            print '%-6s%-24s%10d%10.1f%9d%6d%6d%6d%8d' % (e['step'], 
+                e['description'][:23], e['duration'], e['time'],
+                e['samples'], e['tc'], e['sp'], e['ard'], e['wd'])
+            for f in e['flags']:
+                print '      !! ' + f
+        
+        print '%-30s%10d%10.1f%9d%6d%6d%6d%8d' % ('Total', total['duration'],
+            total['time'], total['samples'], total['tc'], total['sp'],
+            total['ard'], total['wd'])
+        print 'Datalog (kB): ' + str(round(total['datalog']/1000.0, 1))
+        print 'Debuglog (kB): ' + str(round(total['debuglog']/1000.0, 1))
+        
+        return steps, total
+        
         
 class controller():
     """
@@ -475,29 +1192,19 @@ class controller():
     
     def __init__(self, debugLogPath, dataLogPath, recipePath, ports):
         
-        # Initial set up
-        ts = str(time.time())[2:-3] # Repeats at about 100 weeks
-        print 'Timestamp: ', ts  ### Take this out later
-        dtLP = dataLogPath + '_' + ts + '.csv'
-        dbLP = debugLogPath + '_' + ts + '.csv'
-        
-        # Allocate class variables 
-        self.dataLogFile = open(dtLP, 'wb')
-        self.dtF = csv.writer(self.dataLogFile, delimiter=',', 
-                                    escapechar=' ', quoting=csv.QUOTE_NONE)
-        self.debugLogFile = open(dbLP, 'wb')
-        self.dbF = csv.writer(self.debugLogFile, delimiter=',', 
-                                    escapechar=' ', quoting=csv.QUOTE_NONE)
-        self.recipePath = recipePath
-        self.t0 = time.time() # Time the run starts
+        # Devices share one debug log, wrapped so threads can write to it
+        self.dbF = lockedWriter(None)
+        self.dataLogFile = None
+        self.openLogs(debugLogPath, dataLogPath, recipePath)
         
         # Open communications
-        if ports[0]:
-            self.sp = spSerial(ports[0], self.dbF)
-        if ports[1]:
-            self.tc = tcSerial(ports[1], self.dbF)
-        if ports[2]:
-            self.ard = arduinoSerial(ports[2], self.dbF)
+        self.openComms(ports)
+        
+        # Start safety interlock
+        devices = [getattr(self, d) for d in ('tc', 'sp', 'ard') 
+                   if hasattr(self, d)]
+        self.wd = watchdog(devices, self.dbF, getattr(self, 'tc', None))
+        self.wd.start()
         
         # Logging parameters        
         self.headers = [ 
@@ -517,28 +1224,82 @@ class controller():
                   'Volume_Units'
                   ]
         
+    def openLogs(self, debugLogPath, dataLogPath, recipePath):
+        """ Open time stamped debug and data logs for a recipe run.
+        """
+        
+        # Close and archive logs from the previous run
+        if self.dataLogFile:
+            self.dataLogFile.close()
+            self.debugLogFile.close()
+            if ARCHIVE: self.archiveRun()
+        
+        # Initial set up
+        ts = str(time.time())[2:-3] # Repeats at about 100 weeks
+        print 'Timestamp: ', ts  ### Take this out later
+        dtLP = dataLogPath + '_' + ts + '.csv'
+        dbLP = debugLogPath + '_' + ts + '.csv'
+        self.dtLP = dtLP
+        self.dbLP = dbLP
+        
+        # Allocate class variables 
+        self.dataLogFile = open(dtLP, 'wb')
+        self.dtF = csv.writer(self.dataLogFile, delimiter=',', 
+                                    escapechar=' ', quoting=csv.QUOTE_NONE)
+        self.debugLogFile = open(dbLP, 'wb')
+        self.dbF.setWriter(csv.writer(self.debugLogFile, delimiter=',', 
+                                    escapechar=' ', quoting=csv.QUOTE_NONE))
+        self.recipePath = recipePath
+        self.t0 = time.time() # Time the run starts
+        
         # Write initial comments
         self.dataLogFile.flush()
         self.dbF.writerow(['Debug log path: ' + dbLP])
         self.dbF.writerow(['Data log path: ' + dtLP])
         self.dbF.writerow(['Recipe path: ' + self.recipePath])
+        self.dbF.writerow(['Log rate (s): ' + str(LOG_RATE)])
+        self.debugLogFile.flush()
+        
+    def openComms(self, ports):
+        """ Open and handshake all devices at the same time, start up takes
+        as long as the slowest device instead of the sum of all of them.
+        """
+        
+        devices = (('sp', spSerial), ('tc', tcSerial), ('ard', arduinoSerial))
+        threads = []
+        errors = []
+        
+        def connect(name, device, port):
+            try:
+                setattr(self, name, device(port, self.dbF))
+            except Exception as e:
+                errors.append(device.__name__ + ' on ' + port + ': ' + str(e))
+        
+        for (name, device), port in zip(devices, ports):
+            if port:
+                t = threading.Thread(target=connect, args=(name, device, port))
+                t.start()
+                threads.append(t)
+        
+        for t in threads: t.join()
+        
+        # Do not leave the devices that did open holding their ports
+        if errors:
+            for name, device in devices:
+                if hasattr(self, name): getattr(self, name).ser.close()
+            
+            errMsg = 'controller:: Could not open ' + ' | '.join(errors)
+            self.dbF.writerow([errMsg])
+            self.debugLogFile.flush()
+            raise deviceError(errMsg)
+        
         self.debugLogFile.flush()
 
     def getSeconds(self, s):
-        """ Convert stings of this format to seconds.
-        10h-10m-10s
-        3s
-        7m-9s
-        1h-5s
-        """
-        duration = 0
-        
-        for i in s.split('-'):
-            if 'h' in i: duration = duration + int(i.split('h')[0])*3600
-            if 'm' in i: duration = duration + int(i.split('m')[0])*60
-            if 's' in i: duration = duration + int(i.split('s')[0])
-                
-        return duration
+        """ Convert stings of this format to seconds, see getSeconds().
+        """
+        
+        return getSeconds(s)
     
     def quit(self):
         """ Exit controller in a sensible way.
@@ -549,16 +1310,71 @@ class controller():
         print endMsg
         self.dbF.writerow([endMsg]) 
         
-        # Close serial connections
-        self.sp.closeSer()
-        self.tc.closeSer()
-        self.ard.closeSer()
+        try:
+            # Stop watchdog before closing ports it writes to
+            self.wd.stop()
+            
+            # Close serial connections, a dead device must not keep the 
+            # others open
+            for d in (self.sp, self.tc, self.ard):
+                try:
+                    d.closeSer()
+                except Exception as e:
+                    errMsg = 'controller:: ' + d.__class__.__name__ + \
+                        ' close failed: ' + str(e)
+                    print errMsg
+                    self.dbF.writerow([errMsg])
+                    d.ser.close()
+        finally:
+            # Close log files, the run is archived once they are complete
+            self.dataLogFile.close()
+            self.debugLogFile.close()
+            if ARCHIVE: self.archiveRun()
+        
+    def idle(self):
+        """ Put devices in a safe state between recipes, ports stay open.
+        """
+        
+        idleMsg = 'controller:: Run complete, devices idle'
+        print idleMsg
+        self.dbF.writerow([idleMsg])
+        self.wd.disarm()
+        
+        self.sp.send('STP') # Stop the pump
+        self.tc.send('2d', data=self.tc.formatData(0)) # Turn off TC
+        self.ard.send('F',data=[str(0)], delay=ARD_DELAY_CMD) # Turn off fan
+        self.ard.send('P',data=[str(0)], delay=ARD_DELAY_CMD) # Turn off pump
         
-        # Close log files
-        self.dataLogFile.close()
-        self.debugLogFile.close()
+        # Flush buffers, the next run opens its own logs
+        self.dataLogFile.flush()
+        self.debugLogFile.flush()
 
     
+    def nextRate(self, step, row, prev, rate, minRate, maxRate):
+        """ Sample at minRate during transients, otherwise double the 
+        interval up to maxRate.
+        """
+        
+        transient = row[10] > 0 # Air pump running
+        
+        # Away from set point only matters when the TC is driving to it
+        if step[3] == 'Y':
+            transient = transient or abs(row[3] - row[4]) > LOG_BAND
+        
+        if prev is None:
+            transient = True # Step just started, set points changed
+        else:
+            dt = max(row[2] - prev[2], 1)
+            transient = transient or abs(row[3] - prev[3])/dt > LOG_DTDT
+            transient = transient or abs(row[6] - prev[6]) > LOG_EFFORT
+            # Syringe pump still moving
+            transient = transient or row[11:13] != prev[11:13]
+        
+        if transient:
+            return minRate
+        else:
+            return min(2*rate, maxRate)
+    
     def log(self, delay, step, rate=LOG_RATE):
         """ Description: Log data for sleep duration
         Input: datalogFile for writing 
@@ -566,82 +1382,140 @@ class controller():
         """
         
         self.dtF.writerow(self.headers)
+        
+        rates = logRates(step)
+        if rates:
+            self.logAdaptive(delay, step, *rates)
+            return
 
         for i in range(delay/rate):
 
-            row = []
-
-            # Step and description
-            row.append(step[0]) # Number
-            row.append(step[1]) # Description
-
-            # Log time
-            t = int(time.time() - self.t0)
-            print '==========   ' + str(t) + '   =========='
-            row.append(t)
-            
-            # Log spreader plate temperature (C)
-            spTemp = self.tc.send('01')
-            row.append(self.tc.formatResponse(spTemp))
-            
-            # Log spreader plate set point temperature (C)
-            setPoint = self.tc.send('03')
-            row.append(self.tc.formatResponse(setPoint))
-            
-            # Log heatsink temp (C)
-            hsTemp = self.tc.send('06')
-            row.append(self.tc.formatResponse(hsTemp))
-
-            # Log TC effort (%)
-            tcEffort = self.tc.send('04')
-            tcEffort = self.tc.formatResponse(tcEffort)
-            row.append(tcEffort*100)
-            
-            # Log Alarm state
-            ### Potentially could do something with this information
-            ### Could call pause function for error states
-            alarm = self.tc.send('05')
-            alarm = bin(int(alarm[:-2],16))[2:]
-            alarm = (8-len(alarm))*'0'+ alarm
-            r = ''
-            for i in alarm: r = r + i + '.'
-            row.append(str(r[:-1]))
-
-            # Arduino thermistor temperature (C), fan and pump effort (%)
-            r = self.ard.send('Q', delay=ARD_DELAY_QRY)
-            row.append('-')  ### Thermistor not yet implemented
-            row.append(round(100*int(r[1][0])/255.0,2)) # Fan % effort
-            row.append(round(100*int(r[1][1])/255.0,2)) # Pump % effort
-            
-            # Syringe pump vol infuse, vol withdrawn, vol units
-            r = self.sp.dispensed()
-            row.append(r[0]) # Infused
-            row.append(r[1]) # Withdrawn
-            row.append(r[2]) # Units
-            
-            # Add recipe comment to row, assuming comment in last column
-            row.append(step[-1]) 
-            
-            # Populate data and debug logs
-            self.dtF.writerow(row)
-            debugMsg = 'controller:: self.step: '
-            for i in step:
-                debugMsg = debugMsg + ' | ' + str(i)
-            self.dbF.writerow([debugMsg])
-            if DEBUG: 
-                print row
-                print debugMsg
-            else:
-                print 'TC temper (C):  ' + str(row[3])
-                print 'Set point (C):  ' + str(row[4])
-                print 'HS temper (C):  ' + str(row[5])
+            # Watchdog has shut everything down, stop sampling
+            if self.wd.tripped: return
             
-            # Flush buffers in case of crash
-            self.dataLogFile.flush()
-            self.debugLogFile.flush() 
+            self.sample(step)
             
             # Sleep for rate
             time.sleep(rate)
+    
+    def logAdaptive(self, delay, step, minRate, maxRate):
+        """ Log data for sleep duration, interval follows process dynamics.
+        Reports the effective rate and savings against minRate.
+        """
+        
+        tEnd = time.time() + delay
+        rate = minRate
+        prev = None
+        samples = 0
+        size = 0
+        
+        while time.time() < tEnd:
+            
+            # Watchdog has shut everything down, stop sampling
+            if self.wd.tripped: break
+            
+            tSample = time.time()
+            row = self.sample(step)
+            rate = self.nextRate(step, row, prev, rate, minRate, maxRate)
+            prev = row
+            samples = samples + 1
+            size = size + len(','.join([str(i) for i in row])) + 2
+            
+            # Sleep until next sample, never past the end of the step
+            tNext = min(tSample + rate, tEnd)
+            time.sleep(max(0, tNext - time.time()))
+        
+        if not samples: return
+        
+        # Compare with logging at minRate for the whole step
+        fixed = max(int(delay/minRate), samples)
+        saved = (fixed - samples)*size/samples
+        logMsg = 'controller:: Adaptive log: ' + str(samples) + ' samples'
+        logMsg = logMsg + ' || Effective rate (s): '
+        logMsg = logMsg + str(round(float(delay)/samples, 2))
+        logMsg = logMsg + ' || Saved: ' + str(fixed - samples) + ' samples, '
+        logMsg = logMsg + str(saved) + ' bytes'
+        print logMsg
+        self.dbF.writerow([logMsg])
+        
+    def sample(self, step):
+        """ Query all devices once and write a datalog row.
+        Returns the row.
+        """
+        
+        row = []
+
+        # Step and description
+        row.append(step[0]) # Number
+        row.append(step[1]) # Description
+
+        # Log time
+        t = int(time.time() - self.t0)
+        print '==========   ' + str(t) + '   =========='
+        row.append(t)
+        
+        # Log spreader plate temperature (C)
+        spTemp = self.tc.send('01')
+        row.append(self.tc.formatResponse(spTemp))
+        self.wd.update(spTemp=row[-1])
+        
+        # Log spreader plate set point temperature (C)
+        setPoint = self.tc.send('03')
+        row.append(self.tc.formatResponse(setPoint))
+        
+        # Log heatsink temp (C)
+        hsTemp = self.tc.send('06')
+        row.append(self.tc.formatResponse(hsTemp))
+        self.wd.update(hsTemp=row[-1])
+
+        # Log TC effort (%)
+        tcEffort = self.tc.send('04')
+        tcEffort = self.tc.formatResponse(tcEffort)
+        row.append(tcEffort*100)
+        
+        # Log Alarm state, the watchdog acts on any bit set
+        alarm = int(self.tc.send('05')[:-2],16)
+        self.wd.update(alarm=alarm)
+        alarm = bin(alarm)[2:]
+        alarm = (8-len(alarm))*'0'+ alarm
+        r = ''
+        for i in alarm: r = r + i + '.'
+        row.append(str(r[:-1]))
+
+        # Arduino thermistor temperature (C), fan and pump effort (%)
+        r = self.ard.send('Q', delay=ARD_DELAY_QRY)
+        row.append('-')  ### Thermistor not yet implemented
+        row.append(round(100*int(r[1][0])/255.0,2)) # Fan % effort
+        row.append(round(100*int(r[1][1])/255.0,2)) # Pump % effort
+        
+        # Syringe pump vol infuse, vol withdrawn, vol units
+        r = self.sp.dispensed()
+        row.append(r[0]) # Infused
+        row.append(r[1]) # Withdrawn
+        row.append(r[2]) # Units
+        
+        # Add recipe comment to row, assuming comment in last column
+        row.append(step[-1]) 
+        
+        # Populate data and debug logs
+        self.dtF.writerow(row)
+        debugMsg = 'controller:: self.step: '
+        for i in step:
+            debugMsg = debugMsg + ' | ' + str(i)
+        self.dbF.writerow([debugMsg])
+        if DEBUG: 
+            print row
+            print debugMsg
+        else:
+            print 'TC temper (C):  ' + str(row[3])
+            print 'Set point (C):  ' + str(row[4])
+            print 'HS temper (C):  ' + str(row[5])
+        
+        # Flush buffers in case of crash
+        self.dataLogFile.flush()
+        self.debugLogFile.flush() 
+        
+        return row
 
                   
     def pause(self):
@@ -650,9 +1524,12 @@ class controller():
         
         print "Press Enter to continue..."
         waiting = True
+        self.wd.disarm() # Nothing is sampled while waiting
         
         while waiting:
             if msvcrt.getch() == '\r': waiting = False
+        
+        self.wd.rearm()
 
 
     def executeStep(self, step):
@@ -661,6 +1538,9 @@ class controller():
         Output: commands to ard, sp, tc, delay / user resume
         """
         
+        # Do not turn anything back on after the watchdog trips
+        if self.wd.tripped: return
+        
         ### Arduino delay may screw up logging
         # Set Pump Effort
         self.ard.send('P', data=[str(int(255*int(step[6])/100.0))],
@@ -672,27 +1552,28 @@ class controller():
         # Set TC set point
         self.tc.send('1c', data=self.tc.formatData(float(step[4])))
         # Enable or disable TCi
-        if step[3] == 'Y':
+        if step[3] == 'Y' and not self.wd.tripped:
             self.tc.send('2d', data=self.tc.formatData(1)) # TC on
         else:
             self.tc.send('2d', data=self.tc.formatData(0)) # TC off
         
         # Send SP volume and rate if volume != 0
-        if step[7] != 0:
+        if step[7] != 0 and not self.wd.tripped:
             self.sp.basicCommand(int(step[7]), int(step[8]))
         
         # Sleep (ideally this would be multi-threaded or something)
         self.log(self.getSeconds(step[2]), step)
         
         # Wait for user resume if required
-        if step[9] == 'Y':
+        if step[9] == 'Y' and not self.wd.tripped:
             self.pause()
         
         
-    def run(self):
+    def run(self, keepOpen=False):
         """Description: Reads and executes recipe row by row
         Input: Recipe path, spSerial, tcSerial, arduinoSerial
         Output: debugLog, dataLog, pause for user input
+        If keepOpen is set devices are idled instead of closed when done.
         """
         
         recipeFile = open(self.recipePath, 'rb')
@@ -701,33 +1582,109 @@ class controller():
         step = []
         
         self.t0 = time.time()
+        self.wd.arm()
         
-        # Read & execute recipe
-        ### Does not attempt to check for set points changes, just resends
-        for row in recipe:
+        try:
+            # Bad log rates stop the run here rather than part way through
+            checkRecipe(self.recipePath)
+            
+            # Read & execute recipe
+            ### Does not attempt to check for set points changes, just resends
+            for row in recipe:
                         
-            # If header row found append it to datalog and continue
-            if 'Step Number' in row[0]:
-                firstLineFound = True # begin reading recipe
-                continue
+                # If header row found append it to datalog and continue
+                if 'Step Number' in row[0]:
+                    firstLineFound = True # begin reading recipe
+                    continue
             
-            # Append lines before header to datalog
-            if not firstLineFound:
-                self.dtF.writerow(row)
-                continue
+                # Append lines before header to datalog
+                if not firstLineFound:
+                    self.dtF.writerow(row)
+                    continue
             
-            print 'Executing step: ' + row[0] + '  ' + row[1]
+                # Watchdog shut down the devices, abandon the recipe
+                if self.wd.tripped: break
             
-            self.executeStep(row)
+                print 'Executing step: ' + row[0] + '  ' + row[1]
             
-        ctrlr.quit()
+                self.executeStep(row)
+            
+            if keepOpen:
+                self.idle()
+            else:
+                self.quit()
+        except BaseException as e:
+            # Anything, including Ctrl-C, shuts the devices down first
+            self.abort(e)
+            raise
+        finally:
+            recipeFile.close()
+            
+    def archiveRun(self):
+        """ Compress and index the datalog of the finished run, called once
+        its logs are closed. Failures are appended to the debug log and
+        never stop the controller.
+        """
+        
+        try:
+            arc = archive.runArchive()
+            try:
+                arc.ingest(self.dtLP)
+            finally:
+                arc.close()
+        except Exception as e:
+            errMsg = 'controller:: Archive failed: ' + str(e)
+            print errMsg
+            debugLogFile = open(self.dbLP, 'ab')
+            csv.writer(debugLogFile, delimiter=',', escapechar=' ', 
+                       quoting=csv.QUOTE_NONE).writerow([errMsg])
+            debugLogFile.close()
+            
+    def abort(self, e):
+        """ Trip the watchdog for an error in the main loop, devices are 
+        shut down before the error goes any further.
+        """
+        
+        if self.wd.tripped: return
+        
+        reason = 'controller:: ' + e.__class__.__name__ + ' ' + str(e)
+        self.wd.trip(reason)
+        self.debugLogFile.flush()
+            
+    def serve(self):
+        """ Run recipes back to back without reopening serial ports.
+        Prompts for the next recipe file name, blank to quit.
+        """
+        
+        try:
+            self.run(keepOpen=True)
+            
+            while True:
+                name = raw_input('Next recipe file (Enter to quit): ')
+                if not name.strip(): break
+                
+                self.openLogs(*logPaths(name.strip()))
+                self.run(keepOpen=True)
+        except BaseException as e:
+            self.abort(e)
+            raise
+        
+        self.quit()
             
        
 if __name__ == '__main__':
-        
-    ctrlr = controller(dbLP, dtLP, recipe, ports)
-
-    ctrlr.run()
+    
+    if DRY_RUN:
+        arc = archive.runArchive()
+        dryRun(recipe, arc.latencyProfile()).report()
+        arc.close()
+    else:
+        ctrlr = controller(dbLP, dtLP, recipe, ports)
+    
+        if DAEMON:
+            ctrlr.serve()
+        else:
+            ctrlr.run()
 
 #     # Arduino Test here
 #     ### MINIMUM DELAY TO RAMP FROM 0-255 = 2.8 seconds
@@ -744,6 +1701,7 @@ if __name__ == '__main__':
 #     # Execute Test here
 #     # 0step#, 1description, 2duration, 3TC on/off, 4spreader plate temperature,
 #     # 5Fan effort, 6Air Pump effort, 7SygVol, 8SygRate, 9userResume
+#     # Optional: 10minLogRate, 11maxLogRate, then comment last
 #     step1 = ['1','Desc','8s','N',25,0,0,0,0,'N', '# Comment']
 #     ctrlr.executeStep(step1)
 #     step2 = ['2','Desc','8s','Y',30,50,50,500,1900,'N','# Comment']